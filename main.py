@@ -1,15 +1,71 @@
 import json
+import mmap
 import os
 import asyncio
+import contextlib
+import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Set, Tuple
 import re
-from collections import defaultdict
+import shutil
+import sys
+from collections import OrderedDict
 
-from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
+from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger, AstrBotConfig
-from astrbot.api.message_components import At, Plain
+from astrbot.api.message_components import At
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖，缺失时回退到标准库json
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj, indent: bool = False) -> bytes:
+        """序列化为JSON字节串"""
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj, indent: bool = False) -> bytes:
+        """序列化为JSON字节串"""
+        if indent:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+try:
+    from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import AiocqhttpMessageEvent
+except ImportError:
+    AiocqhttpMessageEvent = None
+
+# 从平台返回数据中提取的字段及其默认值，只保留生成描述时用到的字段
+STRANGER_FIELDS = {"nickname": "", "sex": "unknown", "age": 0}
+MEMBER_FIELDS = {"card": "", "title": ""}
+# 旧版本缓存中未被使用的字段，加载时丢弃
+OBSOLETE_FIELDS = ("level", "join_time", "last_sent_time")
+# 快照中记录已合并日志序号的保留键（uid均为数字，不会冲突）
+SNAPSHOT_SEQ_KEY = "__seq__"
+
+# 只需落盘文件数据，平台支持时用fdatasync跳过元数据同步
+_fsync = getattr(os, "fdatasync", os.fsync)
+
+AT_PATTERN = re.compile(r'@(\S+)')
+SEX_MAP_SHORT = {"male": "男", "female": "女", "unknown": "未知"}
+SEX_MAP_FULL = {"male": "男性", "female": "女性", "unknown": "未知"}
+# 取值重复度高的字段，加载时驻留字符串以共享同一对象
+INTERN_FIELDS = ("sex", "title", "cache_time")
+
+
+def _extract_fields(resp, fields: Dict) -> Dict:
+    """按字段表提取平台返回数据，非法返回值视为空"""
+    if not isinstance(resp, dict):
+        return {}
+    return {key: resp.get(key, default) for key, default in fields.items()}
+
 
 @register(
     "astrbot_plugin_gender_detector",
@@ -22,128 +78,394 @@ class GenderDetectorPlugin(Star):
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config
+        # 热路径上的配置项只读取一次，配置修改后AstrBot会重新加载插件
+        self._debug = bool(self.config.get("show_debug", False))
+        self._enable_injection = bool(self.config.get("enable_prompt_injection", True))
+        self._cache_duration = timedelta(hours=self.config.get("cache_duration_hours", 24))
+        self._max_cached_users = int(self.config.get("max_cached_users", 10000))
+        self._max_mentions = int(self.config.get("max_mentions_per_message", 16))
+        self._max_aliases = int(self.config.get("max_aliases", 5))
+        self._scan_concurrency = int(self.config.get("scan_concurrency", 20))
+
         self.plugin_data_dir = "data/plugin_data/astrbot_plugin_gender_detector"
         self.cache_file = os.path.join(self.plugin_data_dir, "user_cache.json")
+        self.cache_log_file = os.path.join(self.plugin_data_dir, "user_cache.log")
         self.scan_schedule_file = os.path.join(self.plugin_data_dir, "scan_schedule.json")
 
         # 确保目录存在
         os.makedirs(self.plugin_data_dir, exist_ok=True)
 
-        # 加载缓存
-        self.user_cache = self._load_cache()
+        # 加载缓存，按最近使用顺序排列，超出上限时淘汰最久未使用的用户
+        self._journal_entries = 0
+        # 最近一条日志记录的序号，快照记录该序号以跳过已合并的日志
+        self._journal_seq = 0
+        self.user_cache: "OrderedDict[str, Dict]" = OrderedDict(self._load_cache())
         self.scan_schedule = self._load_scan_schedule()
+        self._schedule_dirty = False
+        # 待追加到日志的已修改用户
+        self._dirty_uids: Set[str] = set()
+        self._flush_event = asyncio.Event()
+        self._save_lock = asyncio.Lock()
+        # 扫描计划写入共用同一个临时文件，需串行执行
+        self._schedule_lock = asyncio.Lock()
+
+        # 昵称/称呼 -> uid 反向索引
+        # 同名用户可能有多个，值以dict作为有序集合，按加入索引的先后排列
+        self._nick_to_uids: Dict[str, Dict[str, None]] = {}
+        self._alias_to_uids: Dict[str, Dict[str, None]] = {}
+        self._alias_regex: Optional[re.Pattern] = None
+        self._alias_regex_stale = True
+        # 已编译进正则的称呼，以及之后从索引中移除的称呼，两者有变化时才需要重建
+        self._alias_regex_aliases: frozenset = frozenset()
+        self._alias_removed: Set[str] = set()
+        # uid -> 缓存过期的单调时钟时间，避免每次校验都解析ISO时间
+        self._cache_expiry: Dict[str, float] = {}
+        self._expiry_memo: Tuple[Optional[str], Optional[float]] = (None, None)
+        # uid -> 已生成的prompt描述，用户信息更新时失效
+        self._sender_desc_cache: Dict[str, str] = {}
+        self._mention_desc_cache: Dict[str, str] = {}
+        # uid -> 查询失败后暂停重试的截止时间（单调时钟）
+        self._failed_until: Dict[str, float] = {}
+        # uid -> 正在进行的平台查询
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # 限制消息处理中同时进行的平台查询数量
+        self._lookup_sem = asyncio.Semaphore(self._scan_concurrency)
+        for uid in self.user_cache:
+            self._index_user(uid)
+            self._update_expiry(uid)
+        self._evict_users()
+
+        # 启动缓存定期写盘任务
+        self._flush_task = asyncio.create_task(self._cache_flush_task())
 
         # 启动定时扫描任务
+        self._daily_task = None
         if self.config.get("enable_daily_scan", True):
-            asyncio.create_task(self._daily_scan_task())
+            self._daily_task = asyncio.create_task(self._daily_scan_task())
 
         logger.info("astrbot_plugin_gender_detector 插件已初始化")
 
+    @staticmethod
+    def _load_json(file_path: str) -> Dict:
+        """读取JSON文件，优先使用orjson单次解析"""
+        if not os.path.exists(file_path):
+            return {}
+        with open(file_path, 'rb') as f:
+            if orjson is None or os.fstat(f.fileno()).st_size == 0:
+                return _json_loads(f.read())
+            # orjson可直接解析内存映射，避免先复制出完整的bytes
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _json_loads(memoryview(mm))
+
     def _load_cache(self) -> Dict:
-        """加载用户缓存"""
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"加载缓存失败: {e}")
-        return {}
+        """加载用户缓存快照，并重放其后的增量日志"""
+        try:
+            cache = self._load_json(self.cache_file)
+        except Exception as e:
+            logger.error(f"加载缓存失败: {e}")
+            cache = {}
 
-    def _save_cache(self):
-        """保存用户缓存"""
+        snapshot_seq = cache.pop(SNAPSHOT_SEQ_KEY, 0)
+        self._journal_seq = snapshot_seq
         try:
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(self.user_cache, f, ensure_ascii=False, indent=2)
+            self._replay_journal(cache, snapshot_seq)
         except Exception as e:
-            logger.error(f"保存缓存失败: {e}")
+            logger.error(f"加载缓存日志失败: {e}")
+
+        for info in cache.values():
+            if not isinstance(info, dict):
+                continue
+            for key in OBSOLETE_FIELDS:
+                info.pop(key, None)
+            # 旧版本扫描写入的空群字段
+            for key in MEMBER_FIELDS:
+                if key in info and not info[key]:
+                    del info[key]
+            for key in INTERN_FIELDS:
+                value = info.get(key)
+                if isinstance(value, str):
+                    info[key] = sys.intern(value)
+        return cache
+
+    def _replay_journal(self, cache: Dict, snapshot_seq: int):
+        """重放快照之后的增量日志，并截掉末尾写入中断的残行"""
+        if not os.path.exists(self.cache_log_file):
+            return
+        with open(self.cache_log_file, 'rb') as f:
+            data = f.read()
 
-    def _load_scan_schedule(self) -> Dict:
-        """加载扫描计划"""
-        if os.path.exists(self.scan_schedule_file):
+        # 最后一段没有换行结尾，是写入中断留下的残行
+        *lines, torn = data.split(b"\n")
+        for line in lines:
             try:
-                with open(self.scan_schedule_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                entry = _json_loads(line)
+            except ValueError:
+                # 追加中途失败留下的残行直接跳过
+                continue
+            if not isinstance(entry, dict):
+                continue
+            seq = entry.get("seq")
+            if seq is not None:
+                self._journal_seq = max(self._journal_seq, seq)
+                # 快照写入后、删除日志前崩溃时，旧日志已包含在快照中
+                if seq <= snapshot_seq:
+                    continue
+            if entry.get("rec") is None:
+                cache.pop(entry.get("uid"), None)
+            else:
+                cache[entry["uid"]] = entry["rec"]
+            self._journal_entries += 1
+
+        if torn:
+            # 截掉残行，避免之后追加的记录与其拼接成一行而丢失
+            os.truncate(self.cache_log_file, len(data) - len(torn))
+
+    def _mark_cache_dirty(self, uid: str):
+        """标记用户缓存已修改，唤醒写盘任务"""
+        self._dirty_uids.add(uid)
+        self._flush_event.set()
+
+    @staticmethod
+    def _append_bytes(file_path: str, data: bytes):
+        """追加写入文件，文件末尾不是换行时（上次追加中断）先补换行"""
+        with open(file_path, 'ab+') as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    data = b"\n" + data
+            f.write(data)
+            f.flush()
+            _fsync(f.fileno())
+
+    @staticmethod
+    def _write_bytes(file_path: str, data: bytes):
+        """原子写入文件：先写临时文件再替换，避免写入中断产生损坏的JSON"""
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            _fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def _write_snapshot(cls, file_path: str, log_path: str, data: bytes):
+        """原子写入快照后删除已合并的增量日志，快照中的序号保证删除前崩溃时不会重放旧日志"""
+        cls._write_bytes(file_path, data)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(log_path)
+
+    async def _flush_cache(self):
+        """将已修改的用户追加到日志，日志过长时压缩为快照"""
+        if not self._dirty_uids:
+            return
+
+        async with self._save_lock:
+            uids, self._dirty_uids = self._dirty_uids, set()
+            first_seq = self._journal_seq + 1
+            self._journal_seq += len(uids)
+            try:
+                data = b"".join(
+                    _json_dumps({"uid": uid, "rec": self.user_cache.get(uid), "seq": seq}) + b"\n"
+                    for seq, uid in enumerate(uids, first_seq)
+                )
+                await asyncio.to_thread(self._append_bytes, self.cache_log_file, data)
+                self._journal_entries += len(uids)
             except Exception as e:
-                logger.error(f"加载扫描计划失败: {e}")
-        return {}
+                self._dirty_uids |= uids
+                logger.error(f"保存缓存失败: {e}")
+                return
+
+        if self._journal_entries > max(len(self.user_cache), 1000):
+            await self._save_cache()
+
+    async def _cache_flush_task(self):
+        """写盘任务：有修改时被唤醒，等待一个写盘间隔合并后续修改后再写入"""
+        interval = self.config.get("flush_interval_seconds", 30)
+        while True:
+            await self._flush_event.wait()
+            await asyncio.sleep(interval)
+            self._flush_event.clear()
+            try:
+                await self._flush_cache()
+            except Exception as e:
+                # 单次写盘异常不应终止后台任务
+                logger.error(f"定期写盘失败: {e}")
 
-    def _save_scan_schedule(self):
-        """保存扫描计划"""
+    def _index_user(self, uid: str):
+        """将用户的昵称和称呼加入反向索引"""
+        info = self.user_cache.get(uid)
+        if not info:
+            return
+        if info.get("nickname"):
+            self._nick_to_uids.setdefault(info["nickname"], {})[uid] = None
+        for alias in info.get("aliases", []):
+            self._alias_to_uids.setdefault(alias, {})[uid] = None
+            # 刷新用户信息时称呼先移除再加入，称呼集合不变则不需要重建
+            self._alias_removed.discard(alias)
+            if alias not in self._alias_regex_aliases:
+                self._alias_regex_stale = True
+
+    def _unindex_user(self, uid: str):
+        """从反向索引中移除用户的昵称和称呼，并使其描述缓存失效"""
+        self._sender_desc_cache.pop(uid, None)
+        self._mention_desc_cache.pop(uid, None)
+        info = self.user_cache.get(uid)
+        if not info:
+            return
+        self._discard_name(self._nick_to_uids, info.get("nickname"), uid)
+        for alias in info.get("aliases", []):
+            if self._discard_name(self._alias_to_uids, alias, uid):
+                self._alias_removed.add(alias)
+
+    @staticmethod
+    def _discard_name(index: Dict[str, Dict[str, None]], name: Optional[str], uid: str) -> bool:
+        """从名称索引中移除uid，该名称不再对应任何用户时删除并返回True"""
+        uids = index.get(name)
+        if uids is None or uid not in uids:
+            return False
+        del uids[uid]
+        if uids:
+            return False
+        del index[name]
+        return True
+
+    def _expiry_deadline(self, cache_time: str) -> Optional[float]:
+        """将cache_time换算为单调时钟的过期时间，连续相同的时间戳只解析一次"""
+        if self._expiry_memo[0] == cache_time:
+            return self._expiry_memo[1]
+
+        try:
+            expire_at = datetime.fromisoformat(cache_time) + self._cache_duration
+        except (TypeError, ValueError):
+            deadline = None
+        else:
+            deadline = time.monotonic() + (expire_at - datetime.now()).total_seconds()
+        self._expiry_memo = (cache_time, deadline)
+        return deadline
+
+    def _update_expiry(self, uid: str):
+        """根据cache_time计算缓存过期时间"""
+        cache_time = self.user_cache.get(uid, {}).get("cache_time")
+        deadline = self._expiry_deadline(cache_time) if cache_time else None
+        if deadline is None:
+            self._cache_expiry.pop(uid, None)
+        else:
+            self._cache_expiry[uid] = deadline
+
+    def _set_users(self, entries: Dict[str, Dict]):
+        """批量写入用户缓存并维护反向索引，全部写入后统一淘汰"""
+        for uid, user_info in entries.items():
+            self._unindex_user(uid)
+            self.user_cache[uid] = user_info
+            self.user_cache.move_to_end(uid)
+            self._index_user(uid)
+            self._update_expiry(uid)
+            self._mark_cache_dirty(uid)
+        self._evict_users()
+
+    def _set_user(self, uid: str, user_info: Dict):
+        """写入用户缓存并维护反向索引"""
+        self._set_users({uid: user_info})
+
+    def _get_user(self, uid: str) -> Optional[Dict]:
+        """读取用户缓存并刷新其最近使用顺序"""
+        info = self.user_cache.get(uid)
+        if info is not None:
+            self.user_cache.move_to_end(uid)
+        return info
+
+    def _evict_users(self):
+        """淘汰超出上限的最久未使用用户"""
+        while len(self.user_cache) > self._max_cached_users:
+            uid = next(iter(self.user_cache))
+            self._unindex_user(uid)
+            self._cache_expiry.pop(uid, None)
+            del self.user_cache[uid]
+            self._mark_cache_dirty(uid)
+
+    def _get_alias_regex(self) -> Optional[re.Pattern]:
+        """获取匹配所有称呼的正则
+
+        重建的开销与称呼总数成正比，因此只在称呼集合增减后，于下一次使用时统一重建一次；
+        用户信息刷新时称呼不变，不会触发重建。
+        """
+        if self._alias_regex_stale or self._alias_removed:
+            # 零宽前瞻使每个位置都参与匹配，长称呼优先得到该位置上最长的称呼
+            aliases = sorted(self._alias_to_uids, key=len, reverse=True)
+            self._alias_regex = (
+                re.compile("(?=(" + "|".join(map(re.escape, aliases)) + "))") if aliases else None
+            )
+            self._alias_regex_aliases = frozenset(aliases)
+            self._alias_removed.clear()
+            self._alias_regex_stale = False
+        return self._alias_regex
+
+    def _find_uid_by_name(self, name: str) -> Optional[str]:
+        """通过昵称或称呼查找uid，同名时返回最早加入索引的用户"""
+        uids = self._nick_to_uids.get(name) or self._alias_to_uids.get(name)
+        return next(iter(uids)) if uids else None
+
+    async def _save_cache(self):
+        """保存完整的用户缓存快照并清空增量日志，文件写入在线程中执行"""
+        async with self._save_lock:
+            uids, self._dirty_uids = self._dirty_uids, set()
+            try:
+                # 序列化在事件循环内完成，避免线程中遍历被并发修改的字典
+                data = _json_dumps({**self.user_cache, SNAPSHOT_SEQ_KEY: self._journal_seq}, indent=self._debug)
+                await asyncio.to_thread(self._write_snapshot, self.cache_file, self.cache_log_file, data)
+                self._journal_entries = 0
+            except Exception as e:
+                self._dirty_uids |= uids
+                logger.error(f"保存缓存失败: {e}")
+
+    def _load_scan_schedule(self) -> Dict:
+        """加载扫描计划"""
         try:
-            with open(self.scan_schedule_file, 'w', encoding='utf-8') as f:
-                json.dump(self.scan_schedule, f, ensure_ascii=False, indent=2)
+            return self._load_json(self.scan_schedule_file)
         except Exception as e:
-            logger.error(f"保存扫描计划失败: {e}")
+            logger.error(f"加载扫描计划失败: {e}")
+        return {}
+
+    async def _save_scan_schedule(self):
+        """保存扫描计划，多个群同时扫描时串行写入"""
+        async with self._schedule_lock:
+            try:
+                data = _json_dumps(self.scan_schedule, indent=self._debug)
+                await asyncio.to_thread(self._write_bytes, self.scan_schedule_file, data)
+                self._schedule_dirty = False
+            except Exception as e:
+                logger.error(f"保存扫描计划失败: {e}")
 
     def _is_cache_valid(self, uid: str) -> bool:
         """检查缓存是否有效"""
-        if uid not in self.user_cache:
-            return False
-
-        cache_time = self.user_cache[uid].get("cache_time")
-        if not cache_time:
-            return False
-
-        cache_duration = self.config.get("cache_duration_hours", 24)
-        cache_datetime = datetime.fromisoformat(cache_time)
-        return datetime.now() - cache_datetime < timedelta(hours=cache_duration)
+        return self._cache_expiry.get(uid, 0) > time.monotonic()
+
+    @staticmethod
+    def _is_aiocq(event: AstrMessageEvent) -> bool:
+        """是否为aiocqhttp平台的事件"""
+        if AiocqhttpMessageEvent is not None and isinstance(event, AiocqhttpMessageEvent):
+            return True
+        return event.get_platform_name() == "aiocqhttp"
+
+    @classmethod
+    def _aiocq_client(cls, event: AstrMessageEvent):
+        """获取aiocqhttp平台的client对象，其他平台或无法获取client时返回None"""
+        if AiocqhttpMessageEvent is not None and isinstance(event, AiocqhttpMessageEvent):
+            return event.bot
+        if not cls._is_aiocq(event):
+            return None
+
+        client = getattr(event, 'bot', None) or getattr(event.message_obj, 'bot', None)
+        if not client:
+            logger.error("无法获取client对象")
+        return client
 
     async def _get_user_info_from_platform(self, event: AstrMessageEvent, uid: str) -> Optional[Dict]:
         """从平台获取用户信息"""
         try:
-            # 获取平台名称
-            platform_name = event.get_platform_name()
-
-            if platform_name == "aiocqhttp":
-                # 使用更通用的方式获取client
-                try:
-                    # 尝试从event获取bot/client对象
-                    client = None
-                    if hasattr(event, 'bot'):
-                        client = event.bot
-                    elif hasattr(event.message_obj, 'bot'):
-                        client = event.message_obj.bot
-
-                    if not client:
-                        logger.error("无法获取client对象")
-                        return None
-
-                    # 获取用户信息
-                    user_info = await client.api.get_stranger_info(user_id=int(uid))
-
-                    # 如果是群消息，获取群成员信息
-                    group_info = {}
-                    if event.get_group_id():
-                        try:
-                            member_info = await client.api.get_group_member_info(
-                                group_id=int(event.get_group_id()),
-                                user_id=int(uid)
-                            )
-                            group_info = {
-                                "card": member_info.get("card", ""),
-                                "title": member_info.get("title", ""),
-                                "join_time": member_info.get("join_time", ""),
-                                "last_sent_time": member_info.get("last_sent_time", "")
-                            }
-                        except:
-                            pass
-
-                    return {
-                        "uid": uid,
-                        "nickname": user_info.get("nickname", ""),
-                        "sex": user_info.get("sex", "unknown"),
-                        "age": user_info.get("age", 0),
-                        "level": user_info.get("level", 0),
-                        **group_info,
-                        "cache_time": datetime.now().isoformat()
-                    }
-                except Exception as e:
-                    logger.error(f"aiocqhttp平台获取用户信息失败: {e}")
-                    return None
-
-            else:
+            if not self._is_aiocq(event):
                 # 其他平台暂时返回基础信息
-                logger.info(f"平台 {platform_name} 暂不支持获取详细用户信息")
+                logger.info(f"平台 {event.get_platform_name()} 暂不支持获取详细用户信息")
                 return {
                     "uid": uid,
                     "nickname": event.get_sender_name(),
@@ -152,252 +474,372 @@ class GenderDetectorPlugin(Star):
                     "cache_time": datetime.now().isoformat()
                 }
 
+            client = self._aiocq_client(event)
+            if client is None:
+                # aiocqhttp平台暂时拿不到client，不写入缓存；_update_user_cache已提前拦截该情况，不会因此退避
+                return None
+
+            try:
+                # 获取用户信息，群消息时同时并发获取群成员信息
+                user_id = int(uid)
+                tasks = [client.api.get_stranger_info(user_id=user_id)]
+                group_id = event.get_group_id()
+                if group_id:
+                    tasks.append(client.api.get_group_member_info(
+                        group_id=int(group_id),
+                        user_id=user_id
+                    ))
+
+                user_info, *maybe_member = await asyncio.gather(*tasks, return_exceptions=True)
+                if isinstance(user_info, Exception):
+                    raise user_info
+
+                # 群成员信息获取失败时静默忽略
+                member_info = maybe_member[0] if maybe_member else None
+                group_info = _extract_fields(member_info, MEMBER_FIELDS)
+                return {
+                    "uid": uid,
+                    **_extract_fields(user_info, STRANGER_FIELDS),
+                    **{k: v for k, v in group_info.items() if v},
+                    "cache_time": datetime.now().isoformat()
+                }
+            except Exception as e:
+                logger.error(f"aiocqhttp平台获取用户信息失败: {e}")
+                return None
+
         except Exception as e:
             logger.error(f"获取用户信息失败: {e}")
         return None
 
+    def _mark_lookup_failed(self, uid: str):
+        """记录查询失败，在较短的有效期内不再重复请求"""
+        now = time.monotonic()
+        if len(self._failed_until) > 1000:
+            self._failed_until = {k: v for k, v in self._failed_until.items() if v > now}
+        self._failed_until[uid] = now + min(self._cache_duration.total_seconds(), 3600)
+
     async def _update_user_cache(self, event: AstrMessageEvent, uid: str):
-        """更新用户缓存"""
-        if not self._is_cache_valid(uid):
-            user_info = await self._get_user_info_from_platform(event, uid)
+        """更新用户缓存，同一用户的并发更新只请求一次平台"""
+        if self._is_cache_valid(uid) or self._failed_until.get(uid, 0) > time.monotonic():
+            return
+        if self._is_aiocq(event) and self._aiocq_client(event) is None:
+            # client暂时缺失不是查询失败，不记录退避时间，下一条消息重新查询
+            return
+
+        inflight = self._inflight.get(uid)
+        if inflight is not None:
+            # shield避免等待方被取消时连带取消共享的future
+            await asyncio.shield(inflight)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[uid] = future
+        try:
+            async with self._lookup_sem:
+                user_info = await self._get_user_info_from_platform(event, uid)
             if user_info:
-                self.user_cache[uid] = user_info
-                self._save_cache()
-                if self.config.get("show_debug", False):
+                self._set_user(uid, user_info)
+                if self._debug:
                     logger.debug(f"更新用户缓存: {uid} -> {user_info}")
+            else:
+                self._mark_lookup_failed(uid)
+        finally:
+            del self._inflight[uid]
+            if not future.done():
+                future.set_result(None)
+
+    async def _iter_member_infos(self, members: List[Dict]):
+        """将群成员列表转换为缓存条目，定期让出事件循环"""
+        cache_time = datetime.now().isoformat()
+        for i, member in enumerate(members):
+            if i % 200 == 0:
+                # 大群扫描时避免长时间占用事件循环
+                await asyncio.sleep(0)
+
+            if not member.get("user_id"):
+                continue
+
+            uid = str(member["user_id"])
+            # 与单个用户查询一致，空的群字段不写入缓存
+            group_info = _extract_fields(member, MEMBER_FIELDS)
+            yield uid, {
+                "uid": uid,
+                "nickname": member.get("nickname", ""),
+                "sex": member.get("sex", "unknown"),
+                "age": member.get("age", 0),
+                **{k: v for k, v in group_info.items() if v},
+                "cache_time": cache_time
+            }
 
     async def _scan_group_members(self, event: AstrMessageEvent, group_id: str) -> Dict[str, int]:
         """扫描群成员信息"""
         stats = {"male": 0, "female": 0, "unknown": 0}
 
         try:
-            platform_name = event.get_platform_name()
-
-            if platform_name == "aiocqhttp":
-                # 获取client
-                client = None
-                if hasattr(event, 'bot'):
-                    client = event.bot
-                elif hasattr(event.message_obj, 'bot'):
-                    client = event.message_obj.bot
-
-                if not client:
-                    logger.error("无法获取client对象")
-                    return stats
-
-                # 获取群成员列表
-                members = await client.api.get_group_member_list(group_id=int(group_id))
-
-                for member in members:
-                    uid = str(member.get("user_id"))
-                    user_info = await self._get_user_info_from_platform(event, uid)
-
-                    if user_info:
-                        self.user_cache[uid] = user_info
-                        sex = user_info.get("sex", "unknown")
-                        if sex == "male":
-                            stats["male"] += 1
-                        elif sex == "female":
-                            stats["female"] += 1
-                        else:
-                            stats["unknown"] += 1
-
-                self._save_cache()
-
-                # 更新扫描记录
-                self.scan_schedule[group_id] = {
-                    "last_scan": datetime.now().isoformat(),
-                    "member_count": len(members),
-                    "stats": stats
-                }
-                self._save_scan_schedule()
-            else:
-                logger.info(f"平台 {platform_name} 暂不支持群成员扫描")
-
+            if not self._is_aiocq(event):
+                logger.info(f"平台 {event.get_platform_name()} 暂不支持群成员扫描")
+                return stats
+
+            client = self._aiocq_client(event)
+            if client is None:
+                return stats
+
+            # 获取群成员列表
+            members = await client.api.get_group_member_list(group_id=int(group_id))
+
+            # 成员列表已包含所需字段，直接构建后一次性写入缓存
+            new_entries = {uid: info async for uid, info in self._iter_member_infos(members)}
+
+            # 成员列表中性别未知的用户，并发补查陌生人信息
+            unknown_members = [
+                member["user_id"] for member in members
+                if new_entries.get(str(member.get("user_id")), {}).get("sex") == "unknown"
+            ]
+            if unknown_members:
+                sem = asyncio.Semaphore(self._scan_concurrency)
+
+                async def _fetch_stranger(user_id: int):
+                    async with sem:
+                        return str(user_id), await client.api.get_stranger_info(user_id=user_id)
+
+                results = await asyncio.gather(
+                    *[_fetch_stranger(user_id) for user_id in unknown_members],
+                    return_exceptions=True
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        continue
+                    uid, stranger_info = result
+                    fields = _extract_fields(stranger_info, STRANGER_FIELDS)
+                    new_entries[uid].update({k: v for k, v in fields.items() if v})
+
+            self._set_users(new_entries)
+
+            for user_info in new_entries.values():
+                sex = user_info.get("sex", "unknown")
+                stats[sex if sex in stats else "unknown"] += 1
+
+            await self._flush_cache()
+
+            # 更新扫描记录
+            self.scan_schedule[group_id] = {
+                "last_scan": datetime.now().isoformat(),
+                "member_count": len(members),
+                "stats": stats
+            }
+            self._schedule_dirty = True
+            await self._save_scan_schedule()
         except Exception as e:
             logger.error(f"扫描群成员失败: {e}")
 
         return stats
 
+    def _next_scan_time(self) -> datetime:
+        """计算下一次每日扫描的时间"""
+        scan_time = self.config.get("daily_scan_time", "03:00")
+        hour, minute = map(int, scan_time.split(":"))
+
+        now = datetime.now()
+        next_scan = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+        if next_scan <= now:
+            next_scan += timedelta(days=1)
+        return next_scan
+
     async def _daily_scan_task(self):
         """每日扫描任务"""
         while True:
             try:
-                scan_time = self.config.get("daily_scan_time", "03:00")
-                hour, minute = map(int, scan_time.split(":"))
-
-                now = datetime.now()
-                next_scan = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-
-                if next_scan <= now:
-                    next_scan += timedelta(days=1)
+                next_scan = self._next_scan_time()
 
-                wait_seconds = (next_scan - now).total_seconds()
-                await asyncio.sleep(wait_seconds)
+                # 分段睡眠并重新读取系统时间，避免时钟跳变导致错过扫描时间
+                while (remaining := (next_scan - datetime.now()).total_seconds()) > 0:
+                    if remaining > 86400:
+                        # 系统时钟回拨超过一天，重新计算扫描时间
+                        next_scan = self._next_scan_time()
+                        continue
+                    await asyncio.sleep(min(60, remaining))
 
                 # 执行扫描
                 logger.info("开始执行每日群成员扫描")
                 # 这里需要获取所有群列表，但需要有事件触发
                 # 实际实现中可能需要保存群列表
 
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logger.error(f"每日扫描任务错误: {e}")
                 await asyncio.sleep(3600)  # 出错后等待1小时
 
     def _analyze_mentions_in_text(self, text: str) -> List[str]:
         """分析文本中提到的用户"""
-        mentions = []
-
-        # 查找@提及
-        at_pattern = r'@(\S+)'
-        at_matches = re.findall(at_pattern, text)
-        mentions.extend(at_matches)
+        # 以dict作为有序集合去重，达到上限后不再继续匹配
+        seen = {}
+        if not text or not isinstance(text, str):
+            return []
+
+        # 查找@提及，不含@时跳过正则
+        if "@" in text:
+            for match in AT_PATTERN.finditer(text):
+                seen[match.group(1)] = None
+                if len(seen) >= self._max_mentions:
+                    return list(seen)
 
         # 查找可能的称呼（需要根据缓存的称呼进行匹配）
-        for uid, info in self.user_cache.items():
-            if "aliases" in info:
-                for alias in info["aliases"]:
-                    if alias in text:
-                        mentions.append(info.get("nickname", uid))
-                        break
-
-        return list(set(mentions))  # 去重
+        alias_regex = self._get_alias_regex()
+        if alias_regex:
+            for match in alias_regex.finditer(text):
+                # 同一位置上较短的称呼是最长称呼的前缀，逐个检查，与逐个判断alias in text等价
+                longest = match.group(1)
+                for end in range(len(longest), 0, -1):
+                    for uid in self._alias_to_uids.get(longest[:end], ()):
+                        seen[self.user_cache[uid].get("nickname", uid)] = None
+                        if len(seen) >= self._max_mentions:
+                            return list(seen)
+
+        return list(seen)
 
     async def _analyze_history_messages(self, event: AstrMessageEvent, count: int = 100):
         """分析历史消息，提取用户称呼"""
         try:
-            platform_name = event.get_platform_name()
-
-            if platform_name == "aiocqhttp":
-                # 获取client
-                client = None
-                if hasattr(event, 'bot'):
-                    client = event.bot
-                elif hasattr(event.message_obj, 'bot'):
-                    client = event.message_obj.bot
-
-                if not client:
-                    logger.error("无法获取client对象")
-                    return
-
-                # 获取历史消息
-                if event.get_group_id():
-                    try:
-                        messages = await client.api.get_group_msg_history(
-                            group_id=int(event.get_group_id()),
-                            count=count
-                        )
-
-                        # 分析消息中的称呼
-                        user_aliases = defaultdict(set)
-
-                        for msg in messages.get("messages", []):
-                            sender_id = str(msg.get("sender", {}).get("user_id", ""))
-                            message_text = msg.get("message", "")
-
-                            # 提取称呼
-                            mentions = self._analyze_mentions_in_text(message_text)
-
-                            # 更新别名缓存
-                            for mention in mentions:
-                                if sender_id in self.user_cache:
-                                    if "aliases" not in self.user_cache[sender_id]:
-                                        self.user_cache[sender_id]["aliases"] = []
-
-                                    max_aliases = self.config.get("max_aliases", 5)
-                                    if mention not in self.user_cache[sender_id]["aliases"]:
-                                        self.user_cache[sender_id]["aliases"].append(mention)
-                                        self.user_cache[sender_id]["aliases"] = \
-                                            self.user_cache[sender_id]["aliases"][-max_aliases:]
-
-                        self._save_cache()
-                    except Exception as e:
-                        logger.warning(f"获取群消息历史失败，可能是API不支持: {e}")
-                else:
-                    # 私聊历史消息需要其他API
-                    pass
+            client = self._aiocq_client(event)
+
+            if client is None:
+                return
+
+            # 获取历史消息
+            if event.get_group_id():
+                try:
+                    messages = await client.api.get_group_msg_history(
+                        group_id=int(event.get_group_id()),
+                        count=count
+                    )
+
+                    # 先提取(发送者, 文本)，再逐条分析消息中的称呼
+                    records = [
+                        (str(msg.get("sender", {}).get("user_id", "")), msg.get("message", ""))
+                        for msg in messages.get("messages", [])
+                    ]
+
+                    # sender_id -> 新称呼，dict作为有序集合去重
+                    new_aliases: Dict[str, Dict[str, None]] = {}
+                    for sender_id, message_text in records:
+                        if sender_id not in self.user_cache:
+                            continue
+                        # 提取称呼
+                        mentions = self._analyze_mentions_in_text(message_text)
+                        if mentions:
+                            new_aliases.setdefault(sender_id, {}).update(dict.fromkeys(mentions))
+
+                    # 每个用户只更新一次别名缓存
+                    for sender_id, mentions in new_aliases.items():
+                        info = self.user_cache.get(sender_id)
+                        if not info:
+                            continue
+                        aliases = info.get("aliases", [])
+                        merged = list(dict.fromkeys([*aliases, *mentions]))
+                        if len(merged) > len(aliases):
+                            self._set_user(sender_id, {**info, "aliases": merged[-self._max_aliases:]})
+                except Exception as e:
+                    logger.warning(f"获取群消息历史失败，可能是API不支持: {e}")
+            else:
+                # 私聊历史消息需要其他API
+                pass
 
         except Exception as e:
             logger.error(f"分析历史消息失败: {e}")
 
+    def _describe_sender(self, uid: str, info: Dict) -> str:
+        """生成发送者描述，按uid缓存直到用户信息更新"""
+        desc = self._sender_desc_cache.get(uid)
+        if desc is None:
+            sex = SEX_MAP_SHORT.get(info.get("sex", "unknown"), "未知")
+
+            parts = [f"[发送者信息: {info.get('nickname', '未知')}({uid})"]
+            if info.get("card"):
+                parts.append(f", 群名片: {info.get('card')}")
+            if info.get("title"):
+                parts.append(f", 群头衔: {info.get('title')}")
+            parts.append(f", 性别: {sex}")
+            if info.get("age", 0) > 0:
+                parts.append(f", 年龄: {info.get('age')}岁")
+            parts.append("]")
+
+            desc = self._sender_desc_cache[uid] = "".join(parts)
+        return desc
+
+    def _describe_mention(self, uid: str, info: Dict) -> str:
+        """生成被提及用户描述，按uid缓存直到用户信息更新"""
+        desc = self._mention_desc_cache.get(uid)
+        if desc is None:
+            sex = SEX_MAP_SHORT.get(info.get("sex", "unknown"), "未知")
+
+            parts = [f"[@{info.get('nickname', '未知')}({uid}): 性别{sex}"]
+            if info.get("age", 0) > 0:
+                parts.append(f", {info.get('age')}岁")
+            parts.append("]")
+
+            desc = self._mention_desc_cache[uid] = "".join(parts)
+        return desc
+
     @filter.on_llm_request()
     async def modify_llm_prompt(self, event: AstrMessageEvent, req):
         """修改LLM请求的prompt"""
-        if not self.config.get("enable_prompt_injection", True):
+        if not self._enable_injection:
             return
 
         try:
-            # 更新发送者缓存
             sender_id = event.get_sender_id()
-            await self._update_user_cache(event, sender_id)
+            at_uids = list(dict.fromkeys(
+                str(comp.qq) for comp in event.message_obj.message if isinstance(comp, At)
+            ))
+
+            # 仅对缓存失效的用户并发更新，常见的已缓存发送者不产生任何请求
+            stale_uids = [uid for uid in {sender_id, *at_uids} if not self._is_cache_valid(uid)]
+            if stale_uids:
+                await asyncio.gather(*(self._update_user_cache(event, uid) for uid in stale_uids))
 
             # 获取发送者信息
-            sender_info = self.user_cache.get(sender_id, {})
+            sender_info = self._get_user(sender_id) or {}
 
-            # 分析消息中提到的用户
-            mentioned_users = []
+            # 分析消息中提到的用户，同一用户被@和文本同时提及时只计一次
+            mentioned_uids = list(at_uids)
             message_text = event.message_str
 
-            # 检查At消息
-            for comp in event.message_obj.message:
-                if isinstance(comp, At):
-                    at_uid = str(comp.qq)
-                    await self._update_user_cache(event, at_uid)
-                    if at_uid in self.user_cache:
-                        mentioned_users.append(self.user_cache[at_uid])
-
-            # 分析文本中的提及
-            text_mentions = self._analyze_mentions_in_text(message_text)
-            for mention in text_mentions:
-                for uid, info in self.user_cache.items():
-                    if info.get("nickname") == mention or mention in info.get("aliases", []):
-                        mentioned_users.append(info)
-                        break
+            # 分析文本中的提及，没有@且没有已知称呼时跳过
+            if message_text and ("@" in message_text or self._get_alias_regex() is not None):
+                for mention in self._analyze_mentions_in_text(message_text):
+                    uid = self._find_uid_by_name(mention)
+                    if uid:
+                        mentioned_uids.append(uid)
+
+            mentioned_users = []
+            for uid in dict.fromkeys(mentioned_uids):
+                info = self._get_user(uid)
+                if info:
+                    mentioned_users.append((uid, info))
 
             # 构建用户信息描述
             user_info_prefix = []
 
             # 发送者信息
             if sender_info:
-                sex_map = {"male": "男", "female": "女", "unknown": "未知"}
-                sex = sex_map.get(sender_info.get("sex", "unknown"), "未知")
-
-                sender_desc = f"[发送者信息: {sender_info.get('nickname', '未知')}({sender_id})"
-                if sender_info.get("card"):
-                    sender_desc += f", 群名片: {sender_info.get('card')}"
-                if sender_info.get("title"):
-                    sender_desc += f", 群头衔: {sender_info.get('title')}"
-                sender_desc += f", 性别: {sex}"
-                if sender_info.get("age", 0) > 0:
-                    sender_desc += f", 年龄: {sender_info.get('age')}岁"
-                sender_desc += "]"
-
-                user_info_prefix.append(sender_desc)
+                user_info_prefix.append(self._describe_sender(sender_id, sender_info))
 
             # 提及的用户信息
             if mentioned_users:
                 user_info_prefix.append(f"[消息中提及了{len(mentioned_users)}位用户]")
-                for user in mentioned_users:
-                    uid = user.get("uid", "")
-                    sex_map = {"male": "男", "female": "女", "unknown": "未知"}
-                    sex = sex_map.get(user.get("sex", "unknown"), "未知")
-
-                    user_desc = f"[@{user.get('nickname', '未知')}({uid}): 性别{sex}"
-                    if user.get("age", 0) > 0:
-                        user_desc += f", {user.get('age')}岁"
-                    user_desc += "]"
-
-                    # 在原消息中相应位置插入用户信息
-                    # 这里简化处理，只在开头添加
-                    user_info_prefix.append(user_desc)
+                # 在原消息中相应位置插入用户信息
+                # 这里简化处理，只在开头添加
+                user_info_prefix.extend(self._describe_mention(uid, info) for uid, info in mentioned_users)
 
             # 修改prompt
             if user_info_prefix:
-                prefix = "\n".join(user_info_prefix) + "\n\n"
-                req.system_prompt = prefix + req.system_prompt
+                # 一次join完成拼接，空串占位产生前缀与原prompt之间的空行
+                req.system_prompt = "\n".join([*user_info_prefix, "", req.system_prompt])
 
-                if self.config.get("show_debug", False):
-                    logger.debug(f"已注入用户信息到prompt: {prefix}")
+                if self._debug:
+                    logger.debug(f"已注入用户信息到prompt: {user_info_prefix}")
 
         except Exception as e:
             logger.error(f"修改LLM prompt失败: {e}")
@@ -416,15 +858,11 @@ class GenderDetectorPlugin(Star):
 
             # 如果没有@，尝试从文本中提取
             if not target_uid:
-                text = event.message_str.replace("/gender", "").strip()
-                text = text.replace("性别", "").strip()
+                text = event.message_str.replace("/gender", "").replace("性别", "").strip()
 
                 if text:
                     # 在缓存中查找匹配的用户
-                    for uid, info in self.user_cache.items():
-                        if info.get("nickname") == text or text in info.get("aliases", []):
-                            target_uid = uid
-                            break
+                    target_uid = self._find_uid_by_name(text)
 
             # 如果还是没有，查询发送者
             if not target_uid:
@@ -434,25 +872,26 @@ class GenderDetectorPlugin(Star):
             await self._update_user_cache(event, target_uid)
 
             # 获取用户信息
-            user_info = self.user_cache.get(target_uid)
+            user_info = self._get_user(target_uid)
 
             if user_info:
-                sex_map = {"male": "男性", "female": "女性", "unknown": "未知"}
-                sex = sex_map.get(user_info.get("sex", "unknown"), "未知")
+                sex = SEX_MAP_FULL.get(user_info.get("sex", "unknown"), "未知")
 
-                result = f"用户: {user_info.get('nickname', '未知')}({target_uid})\n"
-                result += f"性别: {sex}\n"
+                lines = [
+                    f"用户: {user_info.get('nickname', '未知')}({target_uid})",
+                    f"性别: {sex}"
+                ]
 
                 if user_info.get("age", 0) > 0:
-                    result += f"年龄: {user_info.get('age')}岁\n"
+                    lines.append(f"年龄: {user_info.get('age')}岁")
 
                 if user_info.get("card"):
-                    result += f"群名片: {user_info.get('card')}\n"
+                    lines.append(f"群名片: {user_info.get('card')}")
 
                 if user_info.get("title"):
-                    result += f"群头衔: {user_info.get('title')}\n"
+                    lines.append(f"群头衔: {user_info.get('title')}")
 
-                yield event.plain_result(result.strip())
+                yield event.plain_result("\n".join(lines))
             else:
                 yield event.plain_result("未找到该用户的信息")
 
@@ -479,11 +918,13 @@ class GenderDetectorPlugin(Star):
                 await self._analyze_history_messages(event, history_count)
 
             # 生成统计结果
-            result = f"群成员性别统计完成！\n"
-            result += f"男性: {stats['male']}人\n"
-            result += f"女性: {stats['female']}人\n"
-            result += f"未知: {stats['unknown']}人\n"
-            result += f"总计: {sum(stats.values())}人"
+            result = "\n".join([
+                "群成员性别统计完成！",
+                f"男性: {stats['male']}人",
+                f"女性: {stats['female']}人",
+                f"未知: {stats['unknown']}人",
+                f"总计: {sum(stats.values())}人"
+            ])
 
             yield event.plain_result(result)
 
@@ -493,14 +934,22 @@ class GenderDetectorPlugin(Star):
 
     async def terminate(self):
         """插件卸载时的清理"""
-        self._save_cache()
-        self._save_scan_schedule()
+        for task in (self._daily_task, self._flush_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+        # 仅在有未落盘修改时写入
+        if self._dirty_uids or self._journal_entries:
+            await self._save_cache()
+        if self._schedule_dirty:
+            await self._save_scan_schedule()
 
         # 根据配置决定是否删除数据
         if self.config.get("delete_data_on_unload", False):
             try:
-                import shutil
-                shutil.rmtree(self.plugin_data_dir)
+                await asyncio.to_thread(shutil.rmtree, self.plugin_data_dir)
                 logger.info(f"已删除插件数据目录: {self.plugin_data_dir}")
             except Exception as e:
                 logger.error(f"删除插件数据失败: {e}")
@@ -510,7 +959,7 @@ class GenderDetectorPlugin(Star):
             try:
                 config_file = "data/config/astrbot_plugin_gender_detector_config.json"
                 if os.path.exists(config_file):
-                    os.remove(config_file)
+                    await asyncio.to_thread(os.remove, config_file)
                     logger.info(f"已删除配置文件: {config_file}")
             except Exception as e:
                 logger.error(f"删除配置文件失败: {e}")